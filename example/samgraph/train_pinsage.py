@@ -1,11 +1,12 @@
 import argparse
+import math
 import time
 import torch
 import sys
 import torch as th
 import torch.nn as nn
 import torch.nn.functional as F
-import dgl.function as fn
+import dgl
 import torch.optim as optim
 import numpy as np
 
@@ -26,37 +27,53 @@ class WeightedSAGEConv(nn.Module):
 
         self.act = act
         self.Q = nn.Linear(input_dims, hidden_dims)
-        self.W = nn.Linear(input_dims + hidden_dims, output_dims)
+        # W over cat([n / ws, h_dst]) split by input, so the concat is never built
+        self.W1 = nn.Linear(hidden_dims, output_dims)
+        self.W2 = nn.Linear(input_dims, output_dims, bias=False)
         self.reset_parameters()
         self.dropout = nn.Dropout(dropout)
 
     def reset_parameters(self):
         gain = nn.init.calculate_gain('relu')
         nn.init.xavier_uniform_(self.Q.weight, gain=gain)
-        nn.init.xavier_uniform_(self.W.weight, gain=gain)
+        # same xavier bound as the unsplit (input_dims + hidden_dims) W
+        fan_in = self.W1.in_features + self.W2.in_features
+        bound = gain * math.sqrt(6.0 / (fan_in + self.W1.out_features))
+        nn.init.uniform_(self.W1.weight, -bound, bound)
+        nn.init.uniform_(self.W2.weight, -bound, bound)
         nn.init.constant_(self.Q.bias, 0)
-        nn.init.constant_(self.W.bias, 0)
+        nn.init.constant_(self.W1.bias, 0)
 
     def forward(self, g, h, weights):
         """
         g : graph
         h : node features
-        weights : scalar edge weights
+        weights : scalar edge weights, already cast to float
         """
         h_src, h_dst = h
-        with g.local_scope():
-            g.srcdata['n'] = self.act(self.Q(self.dropout(h_src)))
-            g.edata['w'] = weights.float()
-            g.update_all(fn.u_mul_e('n', 'w', 'm'), fn.sum('m', 'n'))
-            g.update_all(fn.copy_e('w', 'm'), fn.sum('m', 'ws'))
-            n = g.dstdata['n']
-            ws = g.dstdata['ws'].unsqueeze(1).clamp(min=1)
-            z = self.act(self.W(self.dropout(torch.cat([n / ws, h_dst], 1))))
-            z_norm = z.norm(2, 1, keepdim=True)
-            z_norm = torch.where(
-                z_norm == 0, torch.tensor(1.).to(z_norm), z_norm)
-            z = z / z_norm
-            return z
+        h_n = self._pre(h_src)
+        # fused g-SpMM on tensors, no edge messages or frame writes. dgl's
+        # GSpMM casts its inputs to fp16 under autocast and is built without
+        # fp16 kernels, so run the aggregation in fp32 with autocast off
+        with torch.cuda.amp.autocast(enabled=False):
+            n = dgl.ops.u_mul_e_sum(g, h_n.float(), weights)
+            ws = dgl.ops.copy_e_sum(g, weights).unsqueeze(1).clamp(min=1)
+        return self._post(n / ws, h_dst)
+
+    def _pre(self, h_src):
+        return self.act(self.Q(self.dropout(h_src)))
+
+    def _post(self, n_ws, h_dst):
+        # n_ws is a fresh buffer only used here and the division backward
+        # doesn't save it, so drop it in place (eager mode only, don't compile
+        # this). h_dst is a view of the layer input and must not be modified
+        n_ws = F.dropout(n_ws, self.dropout.p, self.training, inplace=True)
+        z = self.act(self.W1(n_ws) + self.W2(self.dropout(h_dst)))
+        # zero rows stay zero, no scalar tensor is built on device. square in
+        # fp32: under autocast z is fp16 and z * z would overflow/underflow
+        inv = torch.rsqrt(z.float().pow(2).sum(1, keepdim=True).clamp_min(1e-24))
+        z = z * inv
+        return z
 
 
 class PinSAGE(nn.Module):
@@ -71,6 +88,8 @@ class PinSAGE(nn.Module):
         self.n_layers = n_layers
         self.n_hidden = n_hidden
         self.n_classes = n_classes
+        # layers are kept separate: each one consumes the previous layer's
+        # output on a differently sized frontier, so their GEMMs can't be grouped
         self.layers = nn.ModuleList()
 
         self.layers.append(WeightedSAGEConv(
@@ -83,8 +102,10 @@ class PinSAGE(nn.Module):
 
     def forward(self, blocks, h):
         for layer, block in zip(self.layers, blocks):
-            h_dst = h[:block.number_of_nodes('DST/' + block.ntypes[0])]
-            h = layer(block, (h, h_dst), block.edata['weights'])
+            # blocks from samgraph have a single dst ntype
+            h_dst = h[:block.num_dst_nodes()]
+            # the sampler produces int32 weights, cast them once per block
+            h = layer(block, (h, h_dst), block.edata['weights'].float())
         return h
 
 
@@ -108,6 +129,8 @@ def parse_args(default_run_config):
         '--lr', type=float, default=default_run_config['lr'])
     argparser.add_argument('--dropout', type=float,
                            default=default_run_config['dropout'])
+    argparser.add_argument('--amp', action='store_true',
+                           default=default_run_config['amp'])
 
     return vars(argparser.parse_args())
 
@@ -118,6 +141,9 @@ def get_run_config():
     run_config.update(get_default_common_config())
     run_config['arch'] = 'arch3'
     run_config['sample_type'] = 'random_walk'
+    # overlap sampling of the next batch with training of the current one,
+    # arch1 doesn't support pipelining and is reset in process_common_config
+    run_config['pipeline'] = True
 
     run_config['random_walk_length'] = 3
     run_config['random_walk_restart_prob'] = 0.5
@@ -127,6 +153,8 @@ def get_run_config():
 
     run_config['lr'] = 0.003
     run_config['dropout'] = 0.5
+    # mixed precision for the dense layers, torch 1.7 autocast is fp16 only
+    run_config['amp'] = False
 
     run_config.update(parse_args(run_config))
 
@@ -161,17 +189,18 @@ def run():
     loss_fcn = nn.CrossEntropyLoss()
     loss_fcn.to(train_device)
     optimizer = optim.Adam(model.parameters(), lr=run_config['lr'])
+    scaler = torch.cuda.amp.GradScaler(enabled=run_config['amp'])
 
     num_epoch = sam.num_epoch()
     num_step = sam.steps_per_epoch()
 
     model.train()
 
-    epoch_sample_times = [0 for i in range(num_epoch)]
-    epoch_copy_times = [0 for i in range(num_epoch)]
-    epoch_convert_times = [0 for i in range(num_epoch)]
-    epoch_train_times = [0 for i in range(num_epoch)]
-    epoch_total_times = [0 for i in range(num_epoch)]
+    epoch_sample_times = np.zeros(num_epoch, dtype=np.float64)
+    epoch_copy_times = np.zeros(num_epoch, dtype=np.float64)
+    epoch_convert_times = np.zeros(num_epoch, dtype=np.float64)
+    epoch_train_times = np.zeros(num_epoch, dtype=np.float64)
+    epoch_total_times = np.zeros(num_epoch, dtype=np.float64)
 
     # sample_times  = [0 for i in range(num_epoch * num_step)]
     # copy_times    = [0 for i in range(num_epoch * num_step)]
@@ -181,6 +210,18 @@ def run():
     # num_nodes     = [0 for i in range(num_epoch * num_step)]
     # num_samples   = [0 for i in range(num_epoch * num_step)]
 
+    # step times are buffered and only logged once per epoch
+    convert_times = np.zeros(num_step, dtype=np.float64)
+    train_times = np.zeros(num_step, dtype=np.float64)
+    total_times = np.zeros(num_step, dtype=np.float64)
+    # loss stays on device and is only read back once per epoch
+    loss_accum = torch.zeros((), device=train_device)
+
+    # the sampler fills a bounded queue (max_sampling_jobs) in background,
+    # get_next_batch only blocks when no prefetched batch is ready
+    if run_config['pipeline']:
+        sam.start()
+
     cur_step_key = 0
     for epoch in range(num_epoch):
         for step in range(num_step):
@@ -189,23 +230,33 @@ def run():
                 epoch * num_step + step, sam.kL0Event_Train_Step)
             if not run_config['pipeline']:
                 sam.sample_once()
-            elif epoch + step == 0:
-                sam.start()
             batch_key = sam.get_next_batch()
             t1 = time.time()
             sam.trace_step_begin_now(batch_key, sam.kL1Event_Convert)
+            # feat/label/graph are already on trainer_ctx: the H2D copy is
+            # issued by samgraph's copy loop on its own stream, so no extra
+            # copy stream or .to(train_device) is needed here. feature rows
+            # hit in the GPU cache (--cache-policy, --cache-percentage) are
+            # gathered on device and only the misses are copied from host
             blocks, batch_input, batch_label = sam.get_dgl_blocks_with_weights(
                 batch_key, num_layer)
             t2 = time.time()
             sam.trace_step_end_now(batch_key, sam.kL1Event_Convert)
             sam.trace_step_begin_now(batch_key, sam.kL1Event_Train)
-            batch_pred = model(blocks, batch_input)
-            loss = loss_fcn(batch_pred, batch_label)
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-            # wait for the train finish then we can free the data safely
+            with torch.cuda.amp.autocast(enabled=run_config['amp']):
+                batch_pred = model(blocks, batch_input)
+                loss = loss_fcn(batch_pred, batch_label)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            # drop the grads right after the step, the next backward starts from None
+            optimizer.zero_grad(set_to_none=True)
+            loss_accum += loss.detach()
+
+            # wait for the train finish then we can free the data safely.
+            # samgraph holds a single current batch and releases it on the
+            # next get_next_batch, so the next batch can't be converted ahead
+            # of this point
             event_sync()
 
             batch_input = None
@@ -219,19 +270,13 @@ def run():
 
             # sample_time = sam.get_log_step_value(epoch, step, sam.kLogL1SampleTime)
             # copy_time = sam.get_log_step_value(epoch, step, sam.kLogL1CopyTime)
-            convert_time = t2 - t1
-            train_time = t3 - t2
-            total_time = t3 - t0
+            convert_times[step] = t2 - t1
+            train_times[step] = t3 - t2
+            total_times[step] = t3 - t0
 
             # num_node = sam.get_log_step_value(epoch, step, sam.kLogL1NumNode)
             # num_sample = sam.get_log_step_value(epoch, step, sam.kLogL1NumSample)
 
-            sam.log_step(epoch, step, sam.kLogL1TrainTime,   train_time)
-            sam.log_step(epoch, step, sam.kLogL1ConvertTime, convert_time)
-            sam.log_epoch_add(epoch, sam.kLogEpochConvertTime, convert_time)
-            sam.log_epoch_add(epoch, sam.kLogEpochTrainTime,   train_time)
-            sam.log_epoch_add(epoch, sam.kLogEpochTotalTime,   total_time)
-
             # sample_times  [cur_step_key] = sample_time
             # copy_times    [cur_step_key] = copy_time
             # convert_times [cur_step_key] = convert_time
@@ -250,6 +295,17 @@ def run():
             # sam.report_step(epoch, step)
             cur_step_key += 1
 
+        for step in range(num_step):
+            sam.log_step(epoch, step, sam.kLogL1TrainTime,   train_times[step])
+            sam.log_step(epoch, step, sam.kLogL1ConvertTime, convert_times[step])
+        sam.log_epoch_add(epoch, sam.kLogEpochConvertTime, convert_times.sum())
+        sam.log_epoch_add(epoch, sam.kLogEpochTrainTime,   train_times.sum())
+        sam.log_epoch_add(epoch, sam.kLogEpochTotalTime,   total_times.sum())
+
+        epoch_loss = float(loss_accum.item()) / num_step
+        loss_accum.zero_()
+        print('Epoch {:05d} | Loss {:.4f}'.format(epoch, epoch_loss))
+
         # sam.report_epoch_average(epoch)
 
         epoch_sample_times[epoch] = sam.get_log_epoch_value(